@@ -1,22 +1,39 @@
+import ast
+import os
+import re
 import sys
-from ast import literal_eval
-from collections.abc import Iterable, Iterator
-from dataclasses import dataclass
-from datetime import datetime, timezone
-from itertools import chain
+from collections import deque
+from collections.abc import Callable, Collection, Iterable, Iterator
+from dataclasses import dataclass, field
+from functools import lru_cache
+from hashlib import blake2b, file_digest
+from itertools import chain, count, islice
 from json import dumps
+from json import loads as json_loads
 from pathlib import Path
-from shutil import rmtree
+from shutil import copyfile, rmtree
+from stat import S_IMODE, S_ISDIR, S_ISREG
 from string import printable
-from subprocess import run
+from threading import Lock, local
 from tomllib import loads
-from typing import Any
+from typing import Any, TextIO
 
 
 REPORT_CONFIG = True
 PACKAGE_NAME = "deploypyfiles"
+CACHE_NAME = f".{PACKAGE_NAME}-cache.json"
 PYTHON_SHEBANGS = ["#!/usr/bin/env python"]
-IDENTIFIER_CHARS = printable[:62] + "_"
+PYTHON_SHEBANG_PREFIXES = tuple(shebang.encode() for shebang in PYTHON_SHEBANGS)
+IDENTIFIER_CHARS = frozenset(printable[:62] + "_")
+DESTINATION_PATTERN = re.compile(rb"^(?:DEPLOY_TARGET|DEPLOYMENT_DESTINATION) = ([^\n]*)", re.M)
+HEAD_LINES = 10
+CHUNK_SIZE = 65536
+MAX_WORKERS = 32
+MAX_TARGET_WORKERS = 8
+OUTPUT = local()
+OUTPUT_LOCK = Lock()
+TEMP_FILES: set[Path] = set()
+TEMP_LOCK = Lock()
 
 
 def main(*opts: str) -> int:
@@ -45,131 +62,285 @@ def deploy(prj: Config) -> bool:
     tprint("# Deploying time!")
     if not prj.targets:
         eprint("No destinations specified, nowhere to deploy :(")
+    sources = (prj.root / path for path in prj.sources)
+    deployables = list(find_deployables(sources, prj.exclude_dirs))
+    dependencies = {source: get_dependencies(source) for source, _ in deployables}
+    templates: list[Path] = []
+    if template := prj.templates.get("DEFAULT"):
+        templates = iterdir(Path(realpath(os.path.join(prj.root, template))), prj.exclude_dirs)
+    args = (deployables, dependencies, templates)
+    unique_targets: dict[str, Path] = {}
+    for root in prj.targets:
+        unique_targets.setdefault(realpath(str(prj.root / root)), root)
+    targets = list(unique_targets.values())
+    if len(targets) < 2:
+        return all([deploy_target(prj, root, *args) for root in targets])
+    from concurrent.futures import ThreadPoolExecutor
+
+    success = True
+    with ThreadPoolExecutor(max_workers=min(MAX_TARGET_WORKERS, len(targets))) as executor:
+        jobs = [executor.submit(buffered, deploy_target, prj, root, *args) for root in targets]
+        errors = []
+        for job in jobs:
+            target_success, output, error = job.result()
+            flush_output(output)
+            success &= target_success
+            if error is not None:
+                errors.append(error)
+    if errors:
+        raise errors[0]
+    return success
+
+
+def deploy_target(
+    prj: Config,
+    destination_root: Path,
+    deployables: list[tuple[Path, Path]],
+    dependencies: dict[Path, list[Path]],
+    templates: list[Path],
+) -> bool:
+    if not destination_root.is_absolute():
+        destination_root = prj.root / destination_root
+    nprint(f"Deploying to {destination_root}")
+    resolved_destination = realpath(str(destination_root))
+    if resolved_destination != str(destination_root):
+        nprint(f"which is aka {resolved_destination}")
+        destination_root = Path(resolved_destination)
     success = True
-    for destination_root in prj.targets:
-        if not destination_root.is_absolute():
-            destination_root = prj.root / destination_root
-        print(f"Deploying to {destination_root}")
-        resolved_destination = destination_root.resolve()
-        if str(resolved_destination) != str(destination_root):
-            print(f"which is aka {resolved_destination}")
-            destination_root = resolved_destination
-        for source, destination in find_deployables(prj.root / path for path in prj.sources):
-            destination = destination_root / destination
-            success |= deploy_file(prj, source, destination)
+    caches: dict[Path, DestinationCache] = {}
+    for source, destination in deployables:
+        destination = destination_root / destination
+        deps = dependencies[source]
+        success &= deploy_file(prj, source, destination, deps, templates, caches)
+    for cache in caches.values():
+        cache.save()
     return success
 
 
-def deploy_file(prj: Config, main_path: Path, destination: Path) -> bool:
-    print(">", main_path.relative_to(prj.root.parent), "->", destination)
+def deploy_file(
+    prj: Config,
+    main_path: Path,
+    destination: Path,
+    dependencies: list[Path],
+    templates: list[Path],
+    caches: dict[Path, DestinationCache],
+) -> bool:
+    nprint(">", prj.relative(main_path), "->", destination)
     source_root = main_path.parent
-    if destination.is_dir():
+    if is_dir(try_stat(destination)):
         destination_root = destination
         main_destination = destination_root / main_path.name
-    elif destination.parent.is_dir():
+    elif is_dir(try_stat(destination.parent)):
         destination_root = destination.parent
         main_destination = destination
     else:
         eprint(f"[FAILURE] Failed to find path {destination}")
         return False
     mapping: dict[Path, Path] = {}
-    for source in chain([main_path], get_dependencies(main_path)):
+    for source in chain([main_path], dependencies):
         dest = destination_root / source.relative_to(source_root)
         if source.stem == main_path.stem:
             dest = dest.with_stem(main_destination.stem)
         if dest in mapping:
             eprint(
                 "[FAILURE] Path collision:\n ",
-                f"{mapping[dest].relative_to(prj.root.parent)} -> {dest}\n ",
-                f"{source.relative_to(prj.root.parent)} -> {dest}",
+                f"{prj.relative(mapping[dest])} -> {dest}\n ",
+                f"{prj.relative(source)} -> {dest}",
             )
             return False
         mapping[dest] = source
-    if template := prj.templates.get("DEFAULT"):
-        template_root = Path(prj.root, template).resolve()
-        for source in iterdir(template_root):
-            dest = destination_root / source.relative_to(template_root)
-            if source.stem in (main_path.stem, "FILESTEM"):
-                dest = dest.with_stem(main_destination.stem)
-            if dest not in mapping:
-                mapping[dest] = source
-    anything_updated = copy_files(prj, mapping)
-    if not prj.archive or not anything_updated:
+    for source in templates:
+        dest = destination_root / source.name
+        if source.stem in (main_path.stem, "FILESTEM"):
+            dest = dest.with_stem(main_destination.stem)
+        mapping.setdefault(dest, source)
+    if destination_root not in caches:
+        caches[destination_root] = DestinationCache.load(destination_root)
+    actions = copy_files(prj, destination_root, mapping, caches[destination_root])
+    if not prj.archive or not any(action in ("new", "update") for action in actions.values()):
         return True
-    archive_files(prj, destination_root, mapping)
+    archive_files(prj, destination_root, mapping, actions)
     return True
 
 
-def copy_files(config: Config, mapping: dict[Path, Path]) -> bool:
-    anything_updated = False
+def copy_files(
+    config: Config,
+    destination_root: Path,
+    mapping: dict[Path, Path],
+    cache: DestinationCache,
+) -> dict[Path, str | None]:
+    actions: dict[Path, str | None] = {}
+    source_digest = lru_cache(maxsize=None)(digest_file)
+    source_stats = {source: source.stat() for source in set(mapping.values())}
+    listings = {directory: scan_dir(directory) for directory in {dest.parent for dest in mapping}}
+    prefix = os.path.join(destination_root, "")
+    keys = {dest: str(dest).removeprefix(prefix) for dest in mapping}
     for dest, source in mapping.items():
-        if dest.is_file():
-            if dest.read_bytes() == source.read_bytes():
-                action = None
-            else:
-                action = "update"
-        elif dest.exists():
-            eprint(f"  [FAILURE] Path already taken: {dest}")
-            action = "error"
+        key = keys[dest]
+        cached = cache.entries.get(key, [])
+        source_stat = source_stats[source]
+        entry = listings[dest.parent].get(dest.name)
+        if entry is None:
+            actions[dest] = "new"
+        elif not entry.is_file():
+            actions[dest] = "error"
+        elif (stat := entry.stat()).st_size != source_stat.st_size:
+            actions[dest] = "update"
+        elif cached[:2] == [stat.st_size, stat.st_mtime_ns] and cached[2:] == [
+            source_digest(source)
+        ]:
+            actions[dest] = None
+        elif files_equal(source, dest):
+            actions[dest] = None
+            cache.entries[key] = [stat.st_size, stat.st_mtime_ns, source_digest(source)]
+            cache.updated = True
         else:
-            action = "new"
-        if action in ("new", "update"):
-            if action == "new":
-                dest.parent.mkdir(parents=True, exist_ok=True)
-            dest.write_bytes(source.read_bytes())
-            anything_updated = True
+            actions[dest] = "update"
+    pending = [dest for dest, action in actions.items() if action in ("new", "update")]
+    for directory in {dest.parent for dest in pending if actions[dest] == "new"}:
+        directory.mkdir(parents=True, exist_ok=True)
+    for dest, stat in zip(pending, write_files([(dest, mapping[dest]) for dest in pending])):
+        cache.entries[keys[dest]] = [stat.st_size, stat.st_mtime_ns, source_digest(mapping[dest])]
+        cache.updated = True
+    for dest, action in actions.items():
         sign = {"new": "+", "update": "u", "error": "?", None: " "}[action]
-        message = " ".join(map(str, [sign, source.relative_to(config.root.parent), "->", dest]))
+        message = " ".join([sign, config.relative(mapping[dest]), "->", str(dest)])
         if sign in "+u":
             gprint(message)
         elif sign in "?":
+            eprint(f"  [FAILURE] Path already taken: {dest}")
             eprint(message)
         else:
-            print(message)
-    return anything_updated
+            nprint(message)
+    return actions
 
 
-def archive_files(config: Config, destination_root: Path, mapping: dict[Path, Path]) -> None:
+def archive_files(
+    config: Config,
+    destination_root: Path,
+    mapping: dict[Path, Path],
+    actions: dict[Path, str | None],
+) -> None:
+    from datetime import datetime, timezone
+
     today = datetime.now(timezone.utc).strftime("%Y-%m-%d")
     for archive in config.archive:
         archive_path = destination_root / archive / today
         rmtree(archive_path, ignore_errors=True)
         archive_path.mkdir(exist_ok=True, parents=True)
+        files = []
         for dest, source in mapping.items():
-            dest = archive_path / dest.relative_to(destination_root)
-            dest.parent.mkdir(parents=True, exist_ok=True)
-            dest.write_bytes(source.read_bytes())
+            archived = archive_path / dest.relative_to(destination_root)
+            files.append((archived, source if actions[dest] == "error" else dest))
+        directories = {archived.parent for archived, _ in files} - {archive_path}
+        for directory in sorted(directories, key=lambda path: len(path.parts)):
+            directory.mkdir(parents=True, exist_ok=True)
+        write_files(files)
         gprint(" ", f"Archived to {archive_path}")
 
 
+def write_files(files: list[tuple[Path, Path]]) -> list[os.stat_result]:
+    if len(files) < 2:
+        return [write_file(dest, source) for dest, source in files]
+    from concurrent.futures import ThreadPoolExecutor
+
+    with ThreadPoolExecutor(max_workers=min(MAX_WORKERS, len(files))) as executor:
+        return list(executor.map(write_file, *zip(*files)))
+
+
+def write_file(dest: Path, source: Path | bytes) -> os.stat_result:
+    target = Path(os.path.realpath(dest))
+    tmp = make_temp(target)
+    try:
+        if isinstance(source, bytes):
+            tmp.write_bytes(source)
+        else:
+            copyfile(source, tmp)
+        if (stat := try_stat(target)) is not None:
+            os.chmod(tmp, S_IMODE(stat.st_mode))
+        os.replace(tmp, target)
+    except BaseException:
+        tmp.unlink(missing_ok=True)
+        raise
+    finally:
+        with TEMP_LOCK:
+            TEMP_FILES.discard(tmp)
+    return target.stat()
+
+
+def make_temp(path: Path) -> Path:
+    tmp = None
+    with TEMP_LOCK:
+        for attempt in count():
+            name = path.with_name(f"{path.name}.{attempt}.tmp-deploy")
+            if name in TEMP_FILES:
+                continue
+            if os.path.islink(name) or os.path.isfile(name):
+                name.unlink(missing_ok=True)
+            elif os.path.lexists(name):
+                continue
+            elif tmp is not None:
+                break
+            if tmp is None:
+                os.close(os.open(name, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666))
+                tmp = name
+        assert tmp is not None
+        TEMP_FILES.add(tmp)
+    return tmp
+
+
+def files_equal(a: Path, b: Path) -> bool:
+    with a.open("rb") as fa, b.open("rb") as fb:
+        if os.fstat(fa.fileno()).st_size != os.fstat(fb.fileno()).st_size:
+            return False
+        while True:
+            chunk = fa.read(CHUNK_SIZE)
+            if chunk != fb.read(CHUNK_SIZE):
+                return False
+            if not chunk:
+                return True
+
+
+def digest_file(path: Path) -> str:
+    with path.open("rb") as file:
+        return file_digest(file, lambda: blake2b(digest_size=16)).hexdigest()
+
+
 def find_deployables(
-    paths: Iterable[Path], guess_destination: bool = True
+    paths: Iterable[Path], exclude_dirs: Collection[str] = ()
 ) -> Iterator[tuple[Path, Path]]:
     for path in paths:
-        if path.is_dir():
-            yield from find_deployables(
-                (path for path in path.iterdir() if path.name[0] not in "._"),
-                guess_destination=False,
-            )
-            continue
-        if not path.is_file():
-            continue
-        lines = path.read_text("utf8", "ignore").splitlines()
-        if path.suffix != ".py" and not any(
-            lines[0].startswith(shebang) for shebang in PYTHON_SHEBANGS
-        ):
-            continue
-        destination = None
-        for line in lines[:10]:
-            if line.startswith("DEPLOY_TARGET = ") or line.startswith("DEPLOYMENT_DESTINATION = "):
-                destination = literal_eval(line.split(" = ", 1)[1])
-        if destination is not None:
-            yield (path, Path(destination))
-        elif guess_destination:
-            yield (path, path.relative_to(path.parent))
+        stat = try_stat(path)
+        if is_dir(stat):
+            for file in walk_files(path, exclude_dirs):
+                head = read_head(file)
+                if is_python_script(file, head):
+                    if (destination := parse_destination(head)) is not None:
+                        yield (Path(file), destination)
+        elif stat is not None and S_ISREG(stat.st_mode):
+            head = read_head(path)
+            if is_python_script(str(path), head):
+                yield (path, parse_destination(head) or Path(path.name))
 
 
-@dataclass
+def read_head(path: str | Path) -> bytes:
+    with open(path, "rb") as file:
+        return b"".join(islice(file, HEAD_LINES))
+
+
+def is_python_script(path: str, head: bytes) -> bool:
+    return path.endswith(".py") or head.startswith(PYTHON_SHEBANG_PREFIXES)
+
+
+def parse_destination(head: bytes) -> Path | None:
+    if b"DEPLOY" not in head:
+        return None
+    if destinations := DESTINATION_PATTERN.findall(head):
+        return Path(ast.literal_eval(destinations[-1].decode("utf8", "ignore").strip()))
+    return None
+
+
+@dataclass(slots=True, eq=False, repr=False)
 class Config:
     root: Path
     src: Path
@@ -179,20 +350,42 @@ class Config:
     sources: list[Path]
     targets: list[Path]
     archive: list[Path]
+    exclude_dirs: set[str]
+
+    root_parent: Path = field(init=False)
+    root_prefix: str = field(init=False)
+
+    def __post_init__(self) -> None:
+        self.root_parent = self.root.parent
+        self.root_prefix = os.path.join(self.root_parent, "")
+
+    def relative(self, path: Path) -> str:
+        string = str(path)
+        if string.startswith(self.root_prefix):
+            return string[len(self.root_prefix) :]
+        return str(path.relative_to(self.root_parent))
 
     @staticmethod
     def from_dict(root: Path, config: dict[str, Any]) -> Config:
-        src_dir = root / "src" if (root / "src").is_file() else root
+        src_dir = root / "src" if (root / "src").is_dir() else root
         templs = {name: Path(str(path)) for name, path in subdict(config, "templates").items()}
         preship = [parse_command(cmd) for cmd in config.get("prerequisites", [])]
         sources = [src_dir.relative_to(root)]
         sources = [Path(str(path)) for path in config.get("deployables", sources)]
         targets = [Path(str(path)) for path in config.get("destinations", [".."])]
         archive = [Path(str(path)) for path in config.get("archives", [])]
+        exclude_dirs = {str(name) for name in config.get("excludes", [])}
         for key in config:
-            if key not in {"templates", "prerequisites", "deployables", "destinations", "archives"}:
+            if key not in {
+                "templates",
+                "prerequisites",
+                "deployables",
+                "destinations",
+                "archives",
+                "excludes",
+            }:
                 eprint(f"Encountered unsupported key {key!r} in pyproject.toml")
-        return Config(root, src_dir, templs, preship, sources, targets, archive)
+        return Config(root, src_dir, templs, preship, sources, targets, archive, exclude_dirs)
 
     def to_toml(self) -> str:
         # TODO: fields
@@ -202,10 +395,39 @@ class Config:
             "deployables = " + tomlify(self.sources),
             "destinations = " + tomlify(self.targets),
             "archives = " + tomlify(self.archive),
+            "excludes = " + tomlify(sorted(self.exclude_dirs)),
         ]
         return "\n".join(config)
 
 
+@dataclass(slots=True)
+class DestinationCache:
+    root: Path
+    entries: dict[str, list[Any]]
+    updated: bool = False
+
+    @staticmethod
+    def load(root: Path) -> DestinationCache:
+        try:
+            entries = json_loads((root / CACHE_NAME).read_text("utf-8", "strict"))
+        except (OSError, ValueError):
+            entries = {}
+        if not isinstance(entries, dict):
+            entries = {}
+        return DestinationCache(
+            root, {key: entry for key, entry in entries.items() if isinstance(entry, list)}
+        )
+
+    def save(self) -> None:
+        if not self.updated:
+            return
+        try:
+            write_file(self.root / CACHE_NAME, dumps(self.entries, indent=1).encode())
+        except OSError as error:
+            eprint(f"  Failed to save {CACHE_NAME}: {error}")
+        self.updated = False
+
+
 # TODO @dataclass (SourceFile): destinaton...
 # and in TOML: sources = ["path1", {source="path2", destination="path3"}]
 # In source we expect DEPLOYMENT_DESTIONATION = "some-path"
@@ -218,6 +440,8 @@ def run_tests(root: Path, tests: list[str] | list[list[str]]) -> list[str]:
         if cmd[0].endswith(".py"):
             cmd = ["python"] + cmd
         tprint("> " + " ".join(cmd))
+        from subprocess import run
+
         if run(
             cmd,
             cwd=root,
@@ -231,58 +455,183 @@ def run_tests(root: Path, tests: list[str] | list[list[str]]) -> list[str]:
 
 
 def get_dependencies(path: Path) -> list[Path]:
-    queue = [path]
-    deps: dict[Path, str] = {}
+    queue = deque([path])
+    deps: list[Path] = []
+    seen: set[Path] = set()
     if path.suffixes == [".py"]:
         stubfile = path.with_suffix(".pyi")
-        if stubfile.exists():
-            deps[stubfile] = path.stem
+        if exists(str(stubfile)):
+            deps.append(stubfile)
+            seen.add(stubfile)
     while queue:
-        path = queue.pop(0)
-        for line in path.read_text("utf-8", "strict").splitlines():
-            line = line.strip()
-            if line.startswith("import ") or line.startswith("from "):
-                mod_name = line.split()[1]
-                mod_path = path.parent / f"{mod_name}.py"
-                if mod_path.is_file() and mod_path not in deps:
-                    deps[mod_path] = mod_name
-                    queue.append(mod_path)
-            elif " = Path(__file__).parent / " in line:
-                path = Path(path.parent, literal_eval(line.split("/", 1)[1]))
-                deps[path] = line.split()[0]
-    return list(deps.keys())
+        module = queue.popleft()
+        mod_names, resources = parse_imports(module)
+        files = list_files(module.parent)
+        for mod_name in mod_names:
+            if (name := f"{mod_name}.py") not in files:
+                continue
+            if (mod_path := module.parent / name) not in seen:
+                deps.append(mod_path)
+                seen.add(mod_path)
+                queue.append(mod_path)
+        for resource in resources:
+            if resource not in seen:
+                deps.append(resource)
+                seen.add(resource)
+    return deps
+
+
+def parse_imports(path: Path) -> tuple[tuple[str, ...], tuple[Path, ...]]:
+    return parse_imports_cached(path, path.stat().st_mtime_ns)
+
+
+@lru_cache(maxsize=None)
+def parse_imports_cached(path: Path, mtime_ns: int) -> tuple[tuple[str, ...], tuple[Path, ...]]:
+    try:
+        tree = ast.parse(path.read_bytes(), filename=str(path))
+    except SyntaxError as error:
+        eprint(f"  [WARNING] Failed to parse {path}: {error}")
+        return (), ()
+    mod_names: list[str] = []
+    resources: list[Path] = []
+    for node in ast.walk(tree):
+        match node:
+            case ast.Import(names=aliases):
+                mod_names.extend(alias.name for alias in aliases)
+            case ast.ImportFrom(module=str() as mod_name, level=0 | 1):
+                mod_names.append(mod_name)
+            case ast.BinOp(
+                left=ast.Attribute(
+                    value=ast.Call(func=ast.Name(id="Path"), args=[ast.Name(id="__file__")]),
+                    attr="parent",
+                ),
+                op=ast.Div(),
+                right=ast.Constant(value=str() as name),
+            ):
+                resources.append(Path(path.parent, name))
+    return tuple(mod_names), tuple(resources)
 
 
 def find_file(root: Path, name: str) -> Path | None:
-    root = root.resolve()
-    for path in chain([root], root.parents):
-        path = Path(path, name)
-        if path.exists():
-            return path
+    root = Path(realpath(str(root)))
+    for directory in chain([root], root.parents):
+        path = os.path.join(directory, name)
+        if exists(path):
+            return Path(path)
     return None
 
 
+@lru_cache(maxsize=1024)
+def realpath(path: str) -> str:
+    return os.path.realpath(path)
+
+
+@lru_cache(maxsize=1024)
+def exists(path: str) -> bool:
+    return try_stat(path) is not None
+
+
+def try_stat(path: str | Path) -> os.stat_result | None:
+    try:
+        return os.stat(path)
+    except OSError:
+        return None
+
+
+def is_dir(stat: os.stat_result | None) -> bool:
+    return stat is not None and S_ISDIR(stat.st_mode)
+
+
+@lru_cache(maxsize=None)
+def list_files(directory: Path) -> frozenset[str]:
+    try:
+        with os.scandir(directory) as entries:
+            return frozenset(entry.name for entry in entries if entry.is_file())
+    except OSError:
+        return frozenset()
+
+
+def scan_dir(path: Path) -> dict[str, os.DirEntry[str]]:
+    try:
+        with os.scandir(path) as entries:
+            return {entry.name: entry for entry in entries}
+    except OSError:
+        return {}
+
+
+TomlTokens = str | list[tuple[str | None, object]]
+
+
 def tomlify(obj: object) -> str:
-    lst: list[object]
-    mapping: dict[str, object]
-    match obj:
-        case list() as lst:
-            return "[" + ", ".join(map(tomlify, lst)) + "]"
-        case dict() as mapping:
-            items: list[str] = []
-            for key, value in mapping.items():
-                assert isinstance(key, str) and all(ch in IDENTIFIER_CHARS for ch in key)
-                items.append(f"{key} = {tomlify(value)}")
-            return "{" + ", ".join(items) + "}"
-        case Path() as path:
-            string = str(path)
-            return f"'{string}'" if "'" not in string else tomlify(string)
-        case str() as string:
-            return dumps(string, ensure_ascii=False)
-        case float() as number:
-            return str(number)
-        case obj:
-            raise NotImplementedError(f"tomlify({obj!r})")
+    chunks: list[str] = []
+    stack: list[tuple[str | None, object]] = [(None, obj)]
+    while stack:
+        chunk, obj = stack.pop()
+        if chunk is not None:
+            chunks.append(chunk)
+            continue
+        emitter = TOML_EMITTERS.get(type(obj)) or find_toml_emitter(obj)
+        tokens = emitter(obj)
+        if isinstance(tokens, str):
+            chunks.append(tokens)
+        else:
+            stack += reversed(tokens)
+    return "".join(chunks)
+
+
+def find_toml_emitter(obj: object) -> Callable[[Any], TomlTokens]:
+    for cls in type(obj).__mro__:
+        if emitter := TOML_EMITTERS.get(cls):
+            TOML_EMITTERS[type(obj)] = emitter
+            return emitter
+    raise NotImplementedError(f"tomlify({obj!r})")
+
+
+def toml_list(lst: list[object]) -> TomlTokens:
+    if not lst:
+        return "[]"
+    tokens: list[tuple[str | None, object]] = []
+    for i, item in enumerate(lst):
+        tokens += [(", " if i else "[", None), (None, item)]
+    tokens.append(("]", None))
+    return tokens
+
+
+def toml_dict(mapping: dict[str, object]) -> TomlTokens:
+    if not mapping:
+        return "{}"
+    tokens: list[tuple[str | None, object]] = []
+    for i, (key, value) in enumerate(mapping.items()):
+        assert isinstance(key, str) and is_bare_key(key)
+        tokens += [((", " if i else "{") + f"{key} = ", None), (None, value)]
+    tokens.append(("}", None))
+    return tokens
+
+
+def toml_path(path: Path) -> TomlTokens:
+    string = str(path)
+    return f"'{string}'" if "'" not in string else toml_str(string)
+
+
+def toml_str(string: str) -> TomlTokens:
+    return dumps(string, ensure_ascii=False)
+
+
+def toml_float(number: float) -> TomlTokens:
+    return str(number)
+
+
+TOML_EMITTERS: dict[type, Callable[[Any], TomlTokens]] = {
+    list: toml_list,
+    dict: toml_dict,
+    Path: toml_path,
+    str: toml_str,
+    float: toml_float,
+}
+
+
+def is_bare_key(key: str) -> bool:
+    return key.isascii() and key.isidentifier() or IDENTIFIER_CHARS.issuperset(key)
 
 
 def subdict(dictionary: dict[str, Any], *keys: str) -> dict[str, Any]:
@@ -300,31 +649,86 @@ def parse_command(command: str | list[str]) -> list[str]:
     return command
 
 
-def iterdir(path: Path) -> list[Path]:
-    paths = [path for path in path.iterdir() if path.stem[:1] not in "._: "]
-    paths.sort(key=str)
-    return paths
+def iterdir(path: Path, exclude: Collection[str] = ()) -> list[Path]:
+    with os.scandir(path) as entries:
+        paths = sorted(
+            entry.path
+            for entry in entries
+            if entry.name[:1] not in "._: " and entry.name not in exclude
+        )
+    return list(map(Path, paths))
+
+
+def walk_files(root: Path, exclude: Collection[str] = ()) -> Iterator[str]:
+    directories = [os.fspath(root)]
+    while directories:
+        files: list[str] = []
+        subdirectories: list[str] = []
+        with os.scandir(directories.pop()) as entries:
+            for entry in entries:
+                if entry.name[0] in "._":
+                    continue
+                if entry.is_dir():
+                    if entry.name not in exclude:
+                        subdirectories.append(entry.path)
+                elif entry.is_file():
+                    files.append(entry.path)
+        files.sort()
+        subdirectories.sort(reverse=True)
+        directories += subdirectories
+        yield from files
+
+
+def buffered(
+    function: Callable[..., bool], *args: Any
+) -> tuple[bool, list[tuple[str, TextIO]], Exception | None]:
+    buffer: list[tuple[str, TextIO]] = []
+    OUTPUT.buffer = buffer
+    try:
+        return function(*args), buffer, None
+    except Exception as error:
+        return False, buffer, error
+    finally:
+        del OUTPUT.buffer
+
+
+def flush_output(output: list[tuple[str, TextIO]]) -> None:
+    with OUTPUT_LOCK:
+        for message, file in output:
+            print(message, file=file, flush=True)
+
+
+def write_output(message: str, file: TextIO) -> None:
+    buffer = getattr(OUTPUT, "buffer", None)
+    if buffer is not None:
+        buffer.append((message, file))
+    else:
+        flush_output([(message, file)])
+
+
+def nprint(*values: object) -> None:
+    write_output(" ".join(map(str, values)), sys.stdout)
 
 
 def tprint(*values: object) -> None:
     message = " ".join(map(str, values))
     if sys.stdout.isatty():
         message = f"\x1b[94m{message}\x1b[0m"
-    print(message, file=sys.stdout, flush=True)
+    write_output(message, sys.stdout)
 
 
 def gprint(*values: object) -> None:
     message = " ".join(map(str, values))
     if sys.stdout.isatty():
         message = f"\x1b[92m{message}\x1b[0m"
-    print(message, file=sys.stdout, flush=True)
+    write_output(message, sys.stdout)
 
 
 def eprint(*values: object) -> None:
     message = " ".join(map(str, values))
     if sys.stderr.isatty():
         message = f"\x1b[91m{message}\x1b[0m"
-    print(message, file=sys.stderr, flush=True)
+    write_output(message, sys.stderr)
 
 
 if __name__ == "__main__":